@@ -0,0 +1,79 @@
+import re
+from functools import lru_cache
+
+from gitlabchangelog.changelog import (  # type: ignore
+    DEFAULT_IGNORE,
+    DEFAULT_TEMPLATE,
+    Changelog as BaseChangelog,
+)
+
+
+_slug_re = re.compile(r"[\s_-]")
+
+
+@lru_cache(maxsize=4096)
+def slug(label):
+    """Return a version of a label that's easy to compare."""
+    return _slug_re.sub("", label.casefold())
+
+
+class LabelFilter:
+    """A compiled set of labels that exclude issues and MRs from the changelog.
+
+    White-space, case, dashes, and underscores are ignored when comparing labels.
+    """
+
+    def __init__(self, labels=DEFAULT_IGNORE):
+        self._ignore = frozenset(slug(label) for label in labels)
+
+    def excludes(self, labels):
+        """Check whether an item with these labels is excluded."""
+        return any(slug(label) in self._ignore for label in labels)
+
+    def filter(self, items):
+        """Lazily drop the excluded items."""
+        return (x for x in items if not self.excludes(x.labels))
+
+
+class Changelog(BaseChangelog):
+    """A Changelog which filters issues and MRs by label as they are listed.
+
+    Items are fetched a page at a time and their labels checked before anything else,
+    so that excluded issues don't cost a `closed_by` request.
+    """
+
+    def __init__(self, repo, label_filter=None, template=DEFAULT_TEMPLATE):
+        super().__init__(repo, template)
+        self._label_filter = label_filter or LabelFilter()
+
+    def _issues(self, start, merge_request_ids):
+        """Collect issues that were closed by merge requests in the tag."""
+        merge_request_ids = set(merge_request_ids)
+        issues = self._repo.issues.list(
+            state="closed",
+            updated_after=start,
+            as_list=False,
+            order_by="updated_at",
+            sort="asc",
+        )
+        return [
+            x
+            for x in self._label_filter.filter(issues)
+            if any(mr["iid"] in merge_request_ids for mr in x.closed_by())
+        ]
+
+    def _merge_requests(self, start, commit_shas):
+        """Collect merge requests that are related to the new commits in the tag."""
+        commit_shas = set(commit_shas)
+        merge_requests = self._repo.mergerequests.list(
+            state="merged",
+            updated_after=start,
+            as_list=False,
+            order_by="updated_at",
+            sort="asc",
+        )
+        return [
+            x
+            for x in self._label_filter.filter(merge_requests)
+            if x.merge_commit_sha in commit_shas
+        ]
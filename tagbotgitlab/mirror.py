@@ -0,0 +1,377 @@
+import base64
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from urllib.parse import quote
+
+
+# 384 MiB, leaving headroom in the default 512 MB of Lambda's /tmp.
+# Larger caches need an EFS mount or more ephemeral storage.
+DEFAULT_MAX_BYTES = 384 * 1024 ** 2
+GIT_TIMEOUT = 20
+# Seconds of the invocation kept back from git, so that there is still time to fall
+# back to the API when it is too slow.
+API_RESERVE = 10
+# Clones are made in temporary directories with this prefix, which are removed by
+# eviction once older than STALE_CLONE_AGE seconds.
+CLONE_PREFIX = ".clone-"
+STALE_CLONE_AGE = 60 * 60
+# Index of the clones' sizes, kept next to them so that eviction doesn't need to walk
+# every clone on every sync.
+SIZES_FILE = "sizes.json"
+# Number of the most recently used clones whose refs are read by the warm-up
+PRIME_CLONES = 5
+
+# Fields of `git for-each-ref refs/tags`. The `*` variants are those of the commit an
+# annotated tag points to, and are empty for lightweight tags.
+TAG_FORMAT = "%00".join(
+    [
+        "%(refname:strip=2)",
+        "%(*objectname)",
+        "%(objectname)",
+        "%(*committerdate:iso-strict)",
+        "%(committerdate:iso-strict)",
+    ]
+)
+
+
+class GitError(Exception):
+    """A git command failed.
+
+    Unlike subprocess' errors, the message never includes the command line.
+    """
+
+
+class Mirror:
+    """A directory of bare clones, fetched incrementally and evicted by size."""
+
+    def __init__(self, root, url, token=None, max_bytes=DEFAULT_MAX_BYTES):
+        self._root = root
+        self._url = url.rstrip("/")
+        self._max_bytes = max_bytes
+        self._auth = {}
+        if token:
+            creds = base64.b64encode(f"oauth2:{token}".encode()).decode()
+            # Pass the token through the environment of each command, so that it is
+            # neither written to the clones' config on disk nor visible in argv.
+            self._auth = {
+                "GIT_CONFIG_COUNT": "1",
+                "GIT_CONFIG_KEY_0": "http.extraHeader",
+                "GIT_CONFIG_VALUE_0": f"Authorization: Basic {creds}",
+            }
+        self._lock = threading.Lock()
+        self._repo_locks = {}
+        # Number of users of each clone, see `use`
+        self._in_use = {}
+        self._deadline = None
+
+    def set_deadline(self, remaining):
+        """Bound git commands by the seconds remaining in the invocation, if any."""
+        self._deadline = None
+        if remaining is not None:
+            self._deadline = time.monotonic() + remaining - API_RESERVE
+
+    def _timeout(self):
+        """Get the timeout of the next git command."""
+        if self._deadline is None:
+            return GIT_TIMEOUT
+        left = self._deadline - time.monotonic()
+        if left <= 0:
+            raise GitError("No time left for git")
+        return min(GIT_TIMEOUT, left)
+
+    def _path(self, repo):
+        """Get the path of the bare clone of a repository."""
+        return os.path.join(self._root, quote(repo, safe="") + ".git")
+
+    def _git(self, *args, path=None):
+        """Run a git command and return its output."""
+        cmd = ["git"]
+        if path:
+            cmd += ["--git-dir", path]
+        try:
+            return subprocess.run(
+                cmd + list(args),
+                check=True,
+                capture_output=True,
+                text=True,
+                timeout=self._timeout(),
+                env={**os.environ, **self._auth, "GIT_TERMINAL_PROMPT": "0"},
+            ).stdout
+        except subprocess.CalledProcessError as e:
+            msg = f"git {args[0]} exited with {e.returncode}: {e.stderr.strip()}"
+            raise GitError(msg) from None
+        except subprocess.TimeoutExpired:
+            raise GitError(f"git {args[0]} timed out") from None
+
+    def _repo_lock(self, path):
+        with self._lock:
+            return self._repo_locks.setdefault(path, threading.Lock())
+
+    def sync(self, repo):
+        """Clone or fetch a repository, returning the path of its bare clone."""
+        path = self._path(repo)
+        with self._repo_lock(path):
+            if self._is_clone(path):
+                print(f"Fetching mirror of {repo}")
+                self._git(
+                    "fetch",
+                    "--prune",
+                    "origin",
+                    "+refs/heads/*:refs/heads/*",
+                    "+refs/tags/*:refs/tags/*",
+                    path=path,
+                )
+            else:
+                print(f"Cloning mirror of {repo}")
+                self._clone(repo, path)
+            # The mtime is used to find the least recently used clones to evict.
+            os.utime(path)
+            size = _du(path)
+        self.evict(keep=path, sizes={os.path.basename(path): size})
+        return path
+
+    def _is_clone(self, path):
+        """Check whether a path holds a usable clone."""
+        if not os.path.isdir(path):
+            return False
+        try:
+            self._git("rev-parse", "--git-dir", path=path)
+        except (OSError, GitError):
+            return False
+        return True
+
+    def _clone(self, repo, path):
+        """Clone a repository, only moving it into place once complete.
+
+        This way a clone that is cut short never leaves a broken repository behind.
+        """
+        os.makedirs(self._root, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=CLONE_PREFIX, dir=self._root)
+        try:
+            # Only the commit graph is needed, so skip downloading file contents.
+            self._git(
+                "clone", "--bare", "--filter=blob:none", f"{self._url}/{repo}.git", tmp
+            )
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp, path)
+        except OSError:
+            # Another container may have moved its own clone into place first.
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not self._is_clone(path):
+                raise
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def evict(self, keep=None, sizes=None):
+        """Remove the least recently used clones until under the size limit.
+
+        Sizes come from the persisted index updated with `sizes`, so only clones
+        missing from it are measured.
+        """
+        if not os.path.isdir(self._root):
+            return
+        index = {**self._read_sizes(), **(sizes or {})}
+        clones = []
+        for name in os.listdir(self._root):
+            path = os.path.join(self._root, name)
+            if name.startswith(CLONE_PREFIX) and _age(path) > STALE_CLONE_AGE:
+                # Left behind by an invocation that was killed mid-clone
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith(".git") and os.path.isdir(path):
+                if name not in index:
+                    index[name] = _du(path)
+                clones.append((_age(path), index[name], name))
+        # Drop the clones that were removed elsewhere
+        index = {name: size for _, size, name in clones}
+        total = sum(index.values())
+        for _, size, name in sorted(clones, reverse=True):
+            if total <= self._max_bytes:
+                break
+            path = os.path.join(self._root, name)
+            # Never evict a clone that this process is syncing or using. Other
+            # processes sharing the directory may still do so, in which case queries
+            # fall back to the API.
+            if path == keep or path in self._in_use or self._repo_lock(path).locked():
+                continue
+            print(f"Evicting mirror {path}")
+            shutil.rmtree(path, ignore_errors=True)
+            del index[name]
+            total -= size
+        self._write_sizes(index)
+
+    def prime(self, recent=PRIME_CLONES):
+        """Read the cache into memory without changing it.
+
+        Stats every clone and reads the refs of the most recently used ones, raising
+        if any of them can't be read.
+        """
+        if not os.path.isdir(self._root):
+            return
+        self._read_sizes()
+        clones = []
+        for name in os.listdir(self._root):
+            path = os.path.join(self._root, name)
+            if name.endswith(".git") and os.path.isdir(path):
+                clones.append((_age(path), path))
+        recent_clones = [path for _, path in sorted(clones)[:recent]]
+        failures = []
+        for path in recent_clones:
+            try:
+                self._git("for-each-ref", f"--format={TAG_FORMAT}", path=path)
+            except (OSError, GitError) as e:
+                failures.append(f"{path}: {e}")
+        if failures:
+            n = len(recent_clones)
+            raise GitError(
+                f"Failed to prime {len(failures)} of {n} clones. " + "; ".join(failures)
+            )
+
+    def _read_sizes(self):
+        try:
+            with open(os.path.join(self._root, SIZES_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_sizes(self, sizes):
+        # Replace the file in one step so that readers never see a partial index.
+        fd, tmp = tempfile.mkstemp(prefix=SIZES_FILE, dir=self._root)
+        with os.fdopen(fd, "w") as f:
+            json.dump(sizes, f)
+        os.replace(tmp, os.path.join(self._root, SIZES_FILE))
+
+    @contextmanager
+    def use(self, project, repo):
+        """Get the mirrored project, keeping its clone from being evicted meanwhile."""
+        path = self._path(repo)
+        with self._lock:
+            self._in_use[path] = self._in_use.get(path, 0) + 1
+        try:
+            yield self.project(project, repo)
+        finally:
+            with self._lock:
+                self._in_use[path] -= 1
+                if not self._in_use[path]:
+                    del self._in_use[path]
+
+    def project(self, project, repo):
+        """Wrap a project so that its git history is read from a local mirror.
+
+        Falls back to the project itself if the mirror can't be synced.
+        """
+        try:
+            path = self.sync(repo)
+        except (OSError, GitError) as e:
+            print(f"Failed to sync mirror of {repo}, using the API: {e}")
+            return project
+        return _Local(
+            project,
+            tags=_Local(
+                project.tags, list=self._fallback(self._tags, path, project.tags.list)
+            ),
+            branches=_Local(
+                project.branches,
+                list=self._fallback(self._branches, path, project.branches.list),
+            ),
+            commits=_Local(
+                project.commits,
+                list=self._fallback(self._commits, path, project.commits.list),
+            ),
+            repository_compare=self._fallback(
+                self._compare, path, project.repository_compare
+            ),
+        )
+
+    def _fallback(self, local, path, remote):
+        """Answer a query from the mirror, or from the API if git fails."""
+
+        def f(*args, **kwargs):
+            try:
+                return local(path, *args, **kwargs)
+            except (OSError, GitError) as e:
+                print(f"Failed to query mirror {path}, using the API: {e}")
+                return remote(*args, **kwargs)
+
+        return f
+
+    def _tags(self, path, **_kwargs):
+        """List tags, in the shape of `ProjectTagManager.list`."""
+        tags = []
+        for line in self._git(
+            "for-each-ref", f"--format={TAG_FORMAT}", "refs/tags", path=path
+        ).splitlines():
+            name, peeled, sha, peeled_date, date = line.split("\0")
+            commit = {"id": peeled or sha, "created_at": peeled_date or date}
+            tags.append(SimpleNamespace(name=name, attributes={"commit": commit}))
+        return tags
+
+    def _branches(self, path, **_kwargs):
+        """List branches, in the shape of `ProjectBranchManager.list`."""
+        default = self._git("symbolic-ref", "--short", "HEAD", path=path).strip()
+        names = self._git(
+            "for-each-ref", "--format=%(refname:strip=2)", "refs/heads", path=path
+        )
+        return [
+            SimpleNamespace(name=name, default=name == default)
+            for name in names.splitlines()
+        ]
+
+    def _commits(self, path, query_parameters=None, **_kwargs):
+        """List commits, in the shape of `ProjectCommitManager.list`."""
+        ref = (query_parameters or {}).get("ref_name", "HEAD")
+        return [
+            SimpleNamespace(id=c["id"], short_id=c["short_id"])
+            for c in self._log(path, ref)
+        ]
+
+    def _compare(self, path, from_, to, **_kwargs):
+        """Compare two refs, in the shape of `Project.repository_compare`."""
+        return {"commits": self._log(path, f"{from_}..{to}", "--reverse")}
+
+    def _log(self, path, rev, *args):
+        out = self._git("log", "--format=%H %h", *args, rev, "--", path=path)
+        commits = []
+        for line in out.splitlines():
+            sha, short = line.split(" ")
+            commits.append({"id": sha, "short_id": short})
+        return commits
+
+
+class _Local:
+    """An API object with some of its attributes answered locally."""
+
+    def __init__(self, remote, **local):
+        self._remote = remote
+        self.__dict__.update(local)
+
+    def __getattr__(self, name):
+        return getattr(self._remote, name)
+
+
+def _age(path):
+    """Get the number of seconds since a path was modified."""
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def _du(path):
+    """Get the total size of the files under a directory."""
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
@@ -3,12 +3,19 @@ import os
 import re
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
 
 import gitlab  # type: ignore
-from gitlabchangelog.changelog import Changelog  # type: ignore
+from gitlabchangelog.changelog import DEFAULT_IGNORE  # type: ignore
+
+from tagbotgitlab.changelog import Changelog, LabelFilter
+from tagbotgitlab.mirror import DEFAULT_MAX_BYTES, Mirror
 
 
 POLL_TIMEOUT = 1
+RELEASE_WORKERS = 4
 
 # Note we stop matching at '<' (or whitespace characters) because the MR body may
 # contain HTML elements such as `<br>`, which are not part of the fields' values.
@@ -16,6 +23,15 @@ POLL_TIMEOUT = 1
 re_repo = re.compile("Repository:\\s*(http[s]?://)?([^/\\s]+/)([^\\s<]*)")
 re_version = re.compile("Version:\\s*(v[^\\s<]*)")
 re_commit = re.compile("Commit:\\s*([^\\s<]*)")
+# The same fields combined into a single pattern, so that MR bodies registering several
+# packages can be scanned for every registration block in one pass. Blank lines are
+# matched too, as a registration block never spans one.
+re_field = re.compile(
+    "Repository:\\s*(http[s]?://)?([^/\\s]+/)(?P<repo>[^\\s<]*)"
+    "|Version:\\s*(?P<version>v[^\\s<]*)"
+    "|Commit:\\s*(?P<commit>[^\\s<]*)"
+    "|(?P<gap>\\n[ \\t]*\\r?\\n)"
+)
 
 merge = os.getenv("AUTOMATIC_MERGE", "").lower() == "true"
 registrator = int(os.environ["REGISTRATOR_ID"])
@@ -23,10 +39,31 @@ token = os.environ["GITLAB_WEBHOOK_TOKEN"]
 client = gitlab.Gitlab(
     os.environ["GITLAB_URL"], private_token=os.environ["GITLAB_API_TOKEN"]
 )
+# Optional local cache of bare clones, used to answer git history queries when
+# generating changelogs instead of the GitLab API.
+mirror = None
+if os.getenv("GIT_MIRROR_DIR"):
+    mirror = Mirror(
+        os.environ["GIT_MIRROR_DIR"],
+        os.environ["GITLAB_URL"],
+        os.environ["GITLAB_API_TOKEN"],
+        int(os.getenv("GIT_MIRROR_MAX_BYTES", DEFAULT_MAX_BYTES)),
+    )
+
+# Labels excluding issues and MRs from changelogs, in addition to the defaults.
+# A JSON object mapping project paths, or "*" for all projects, to lists of labels.
+ignore_labels = json.loads(os.getenv("CHANGELOG_IGNORE") or "{}")
 
 
 def handler(evt, _ctx):
     """Lambda entrypoint."""
+    # Set for every invocation, warm-ups included, so that no deadline is left over
+    # from a previous one.
+    if mirror:
+        remaining = _ctx.get_remaining_time_in_millis() / 1000 if _ctx else None
+        mirror.set_deadline(remaining)
+    if is_warmup(evt):
+        return handle_warmup()
     try:
         if get_in(evt, "headers", "X-Gitlab-Token") != token:
             status, msg = 403, "Invalid token"
@@ -40,6 +77,41 @@ def handler(evt, _ctx):
     return {"statusCode": status, "body": msg or "No error"}
 
 
+def is_warmup(evt):
+    """Check whether the event was sent by the scheduled warm-up trigger."""
+    return (
+        evt.get("source") == "aws.events"
+        and evt.get("detail-type") == "Scheduled Event"
+    )
+
+
+def handle_warmup():
+    """Prime imports, connections, and caches, without making any changes."""
+    steps = [
+        # Compiling the template pulls in the rest of the changelog stack
+        ("changelog", lambda: Changelog(None)),
+        # Opens the pooled connection to GITLAB_URL and validates the API token
+        ("api", client.auth),
+    ]
+    if mirror:
+        # Reads the clones on disk, leaving eviction to the syncs
+        steps.append(("mirror", mirror.prime))
+    status, timings = 200, {}
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+            ok = True
+        except Exception:
+            traceback.print_exc()
+            status, ok = 500, False
+        ms = round((time.perf_counter() - start) * 1000, 1)
+        timings[name] = {"ok": ok, "ms": ms}
+    msg = json.dumps({"warmup": timings})
+    print(f"STATUS : {status}\nINFO : {msg}")
+    return {"statusCode": status, "body": msg}
+
+
 def handle_event(payload):
     """Handle a GitLab event."""
     # MR event payload format :
@@ -117,27 +189,45 @@ def handle_merge(payload):
         return "Target branch is not the default"
     body = get_in(payload, "object_attributes", "description", default="")
     print(f"MR body:\n{body}")
-    repo, version, commit, err = parse_body(body)
-    if err:
+    # Repeated blocks, e.g. an echoed description, would create the same tag twice
+    registrations = list(dict.fromkeys(parse_registrations(body)))
+    if not registrations:
+        _, _, _, err = parse_body(body)
+        err = err or "Fields out of order"
         raise Exception("Parsing MR description failed. " + err)
-    p = client.projects.get(repo, lazy=True)
-
-    changelog = Changelog(p)
-    release_notes = changelog.get(version, commit)
-
-    print(f"Creating release and tag {version} for {repo} at {commit}")
-    p.releases.create(
-        {
-            "tag_name": version,
-            "ref": commit,
-            "description": release_notes,
-            # This can be removed after
-            # https://github.com/python-gitlab/python-gitlab/pull/1555 is released
-            "name": version,
-        }
-    )
 
-    return f"Created release and tag {version} for {repo} at {commit}"
+    with ThreadPoolExecutor(max_workers=RELEASE_WORKERS) as pool:
+        results = list(pool.map(lambda r: create_release(*r), registrations))
+    msg = "\n".join(m for _, m in results)
+    if not all(ok for ok, _ in results):
+        raise Exception("Creating releases failed.\n" + msg)
+    return msg
+
+
+def create_release(repo, version, commit):
+    """Create the release and tag for a single registered package."""
+    try:
+        p = client.projects.get(repo, lazy=True)
+
+        with mirror.use(p, repo) if mirror else nullcontext(p) as project:
+            changelog = Changelog(project, label_filter(repo))
+            release_notes = changelog.get(version, commit)
+
+        print(f"Creating release and tag {version} for {repo} at {commit}")
+        p.releases.create(
+            {
+                "tag_name": version,
+                "ref": commit,
+                "description": release_notes,
+                # This can be removed after
+                # https://github.com/python-gitlab/python-gitlab/pull/1555 is released
+                "name": version,
+            }
+        )
+    except Exception:
+        traceback.print_exc()
+        return False, f"Failed to create release and tag {version} for {repo}"
+    return True, f"Created release and tag {version} for {repo} at {commit}"
 
 
 def parse_body(body):
@@ -159,6 +249,36 @@ def parse_body(body):
     return repo, version, commit, None
 
 
+def parse_registrations(body):
+    """Parse every registration in the MR body, yielding (repo, version, commit).
+
+    Registrator writes the repository first in each registration, so it always starts
+    a new one; the version and commit may follow in any order. Registrations that are
+    incomplete, repeat a field, or span a blank line are dropped rather than being
+    completed with another registration's fields.
+    """
+    block = None
+    for m in re_field.finditer(body):
+        field = m.lastgroup
+        if field == "repo":
+            block = {}
+        elif field == "gap" or block is None or field in block:
+            block = None
+            continue
+        block[field] = m[field].strip()
+        if len(block) == 3:
+            yield block["repo"], block["version"], block["commit"]
+            block = None
+
+
+@lru_cache()
+def label_filter(repo):
+    """Get the changelog label filter for a project."""
+    return LabelFilter(
+        [*DEFAULT_IGNORE, *ignore_labels.get("*", []), *ignore_labels.get(repo, [])]
+    )
+
+
 def get_in(d, *keys, default=None):
     """Get a nested value from a dict."""
     for k in keys:
@@ -0,0 +1,93 @@
+import random
+import time
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import gitlab
+from gitlabchangelog.changelog import Changelog as BaseChangelog
+
+from tagbotgitlab.changelog import Changelog, LabelFilter, slug
+
+
+def test_slug():
+    assert slug("Changelog Skip") == "changelogskip"
+    assert slug("wont-fix") == slug("Wont_Fix") == slug("wont fix") == "wontfix"
+
+
+def test_label_filter():
+    f = LabelFilter()
+    assert f.excludes(["bug", "WONT_FIX"])
+    assert f.excludes(["Changelog-Skip"])
+    assert not f.excludes(["bug", "enhancement"])
+    assert not f.excludes([])
+
+    f = LabelFilter(["internal"])
+    assert f.excludes(["Internal"])
+    assert not f.excludes(["wont fix"])
+
+    items = [SimpleNamespace(labels=["bug"]), SimpleNamespace(labels=["Internal"])]
+    assert list(f.filter(items)) == items[:1]
+
+
+def test_changelog():
+    p = Mock(spec=gitlab.v4.objects.Project)
+    p.issues = Mock(spec=gitlab.v4.objects.ProjectIssueManager)
+    p.mergerequests = Mock(spec=gitlab.v4.objects.ProjectMergeRequestManager)
+
+    kept = Mock(labels=["bug"], merge_commit_sha="a")
+    skipped = Mock(labels=["Changelog Skip"], merge_commit_sha="b")
+    other = Mock(labels=[], merge_commit_sha="c")
+    p.mergerequests.list = Mock(return_value=iter([kept, skipped, other]))
+    changelog = Changelog(p)
+    assert changelog._merge_requests(None, ["a", "b"]) == [kept]
+    assert p.mergerequests.list.call_args.kwargs["as_list"] is False
+
+    kept = Mock(labels=["bug"])
+    kept.closed_by = Mock(return_value=[{"iid": 1}])
+    skipped = Mock(labels=["internal"])
+    unrelated = Mock(labels=[])
+    unrelated.closed_by = Mock(return_value=[{"iid": 2}])
+    p.issues.list = Mock(return_value=iter([kept, skipped, unrelated]))
+    changelog = Changelog(p, LabelFilter(["internal"]))
+    assert changelog._issues(None, [1]) == [kept]
+    assert p.issues.list.call_args.kwargs["as_list"] is False
+    # excluded issues are dropped before asking the API what closed them
+    skipped.closed_by.assert_not_called()
+
+
+def test_label_filter_10k():
+    """Micro-benchmark the label filter against a 10k-item history."""
+    rng = random.Random(0)
+    labels = [
+        "bug",
+        "enhancement",
+        "documentation",
+        "Changelog Skip",
+        "wont_fix",
+        "Won't-Fix",
+        "question",
+        "needs review",
+    ]
+    items = [
+        Mock(labels=rng.sample(labels, rng.randint(0, 3)), merge_commit_sha=str(i))
+        for i in range(10_000)
+    ]
+    shas = [x.merge_commit_sha for x in items]
+
+    def run(changelog_type):
+        p = Mock(spec=gitlab.v4.objects.Project)
+        p.mergerequests = Mock(spec=gitlab.v4.objects.ProjectMergeRequestManager)
+        p.mergerequests.list = Mock(side_effect=lambda **_kwargs: iter(items))
+        changelog = changelog_type(p)
+        start = time.perf_counter()
+        merge_requests = changelog._merge_requests(None, shas)
+        return merge_requests, time.perf_counter() - start
+
+    expected, base_time = run(BaseChangelog)
+    slug.cache_clear()
+    merge_requests, filter_time = run(Changelog)
+    assert merge_requests == expected
+    assert 0 < len(merge_requests) < len(items)
+    # every distinct label is only normalised once
+    assert slug.cache_info().misses <= len(labels) + len(LabelFilter()._ignore)
+    print(f"10k items: base {base_time:.3f}s, label filter {filter_time:.3f}s")
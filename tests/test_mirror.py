@@ -0,0 +1,242 @@
+import json
+import os
+import subprocess
+from unittest.mock import Mock, patch
+
+import gitlab.v4.objects
+import pytest
+
+from tagbotgitlab.mirror import GitError, Mirror, _du
+
+
+def git(path, *args):
+    return subprocess.run(
+        ["git", "-C", path, "-c", "user.name=foo", "-c", "user.email=foo@bar.com"]
+        + list(args),
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    """A repository served at <tmp_path>/remote/foo/bar.git with two tags."""
+    path = str(tmp_path / "remote" / "foo" / "bar.git")
+    os.makedirs(path)
+    git(path, "init", "-b", "main")
+    shas = []
+    for i in range(4):
+        git(path, "commit", "--allow-empty", "-m", f"commit {i}")
+        shas.append(git(path, "rev-parse", "HEAD"))
+    git(path, "tag", "v0.1.0", shas[1])
+    git(path, "tag", "-a", "v0.2.0", "-m", "v0.2.0", shas[2])
+    git(path, "branch", "develop", shas[0])
+    return f"file://{tmp_path / 'remote'}", path, shas
+
+
+def make_project():
+    p = Mock(spec=gitlab.v4.objects.Project)
+    p.tags = Mock(spec=gitlab.v4.objects.ProjectTagManager)
+    p.tags.gitlab = Mock(spec=gitlab.Gitlab)
+    p.branches = Mock(spec=gitlab.v4.objects.ProjectBranchManager)
+    p.commits = Mock(spec=gitlab.v4.objects.ProjectCommitManager)
+    p.issues = Mock(spec=gitlab.v4.objects.ProjectIssueManager)
+    return p
+
+
+def test_sync(tmp_path, upstream):
+    url, path, shas = upstream
+    mirror = Mirror(str(tmp_path / "cache"), url)
+
+    clone = mirror.sync("foo/bar")
+    assert clone == str(tmp_path / "cache" / "foo%2Fbar.git")
+    assert git(clone, "rev-parse", "main") == shas[-1]
+
+    # new commits and tags are fetched incrementally
+    git(path, "commit", "--allow-empty", "-m", "commit 4")
+    git(path, "tag", "v0.3.0")
+    assert mirror.sync("foo/bar") == clone
+    assert git(clone, "rev-parse", "main") == git(path, "rev-parse", "HEAD")
+    assert git(clone, "tag", "--list", "v0.3.0") == "v0.3.0"
+
+
+def test_sync_broken_clone(tmp_path, upstream):
+    url, _path, shas = upstream
+    cache = tmp_path / "cache"
+    mirror = Mirror(str(cache), url)
+
+    # a directory left behind by an interrupted clone is cloned again
+    broken = cache / "foo%2Fbar.git"
+    os.makedirs(broken / "objects")
+    clone = mirror.sync("foo/bar")
+    assert clone == str(broken)
+    assert git(clone, "rev-parse", "main") == shas[-1]
+    # and the temporary clone was moved into place
+    assert sorted(os.listdir(cache)) == ["foo%2Fbar.git", "sizes.json"]
+
+    # failed clones leave nothing behind
+    with pytest.raises(GitError):
+        mirror.sync("foo/missing")
+    assert sorted(os.listdir(cache)) == ["foo%2Fbar.git", "sizes.json"]
+
+
+def test_sync_token(tmp_path, upstream, capsys):
+    url, _path, _shas = upstream
+    mirror = Mirror(str(tmp_path / "cache"), url, token="secrettoken")
+    creds = "b2F1dGgyOnNlY3JldHRva2Vu"  # base64 of oauth2:secrettoken
+
+    # the token is passed to git, but never on its command line
+    with patch("subprocess.run", wraps=subprocess.run) as run:
+        mirror.sync("foo/bar")
+    for c in run.call_args_list:
+        assert not any(creds in arg for arg in c.args[0])
+        assert c.kwargs["env"]["GIT_CONFIG_VALUE_0"] == f"Authorization: Basic {creds}"
+
+    # failures never print the token
+    with pytest.raises(GitError) as e:
+        mirror.sync("foo/missing")
+    assert "secrettoken" not in str(e.value) and creds not in str(e.value)
+    assert e.value.__suppress_context__
+    p = make_project()
+    assert mirror.project(p, "foo/missing") is p
+    out, err = capsys.readouterr()
+    assert "Failed to sync mirror of foo/missing" in out
+    assert "secrettoken" not in out + err and creds not in out + err
+
+
+def test_project(tmp_path, upstream):
+    url, _path, shas = upstream
+    mirror = Mirror(str(tmp_path / "cache"), url)
+    p = make_project()
+    local = mirror.project(p, "foo/bar")
+
+    # lightweight and annotated tags both point at their commit
+    tags = {t.name: t.attributes["commit"] for t in local.tags.list(all=True)}
+    assert tags.keys() == {"v0.1.0", "v0.2.0"}
+    assert tags["v0.1.0"]["id"] == shas[1]
+    assert tags["v0.2.0"]["id"] == shas[2]
+    assert tags["v0.2.0"]["created_at"]
+
+    branches = {b.name: b.default for b in local.branches.list()}
+    assert branches == {"main": True, "develop": False}
+
+    commits = local.commits.list(all=True, query_parameters={"ref_name": "main"})
+    assert [c.id for c in commits] == shas[::-1]
+    assert shas[0].startswith(commits[-1].short_id)
+
+    compare = local.repository_compare("v0.1.0", shas[-1])
+    assert [c["id"] for c in compare["commits"]] == shas[2:]
+
+    # nothing was asked of the API, and everything else is delegated to it
+    p.tags.list.assert_not_called()
+    p.branches.list.assert_not_called()
+    p.commits.list.assert_not_called()
+    p.repository_compare.assert_not_called()
+    assert local.issues is p.issues
+    assert local.tags.gitlab is p.tags.gitlab
+
+    # unknown commits fall back to the API
+    p.repository_compare = Mock(return_value={"commits": []})
+    local = mirror.project(p, "foo/bar")
+    assert local.repository_compare("v0.1.0", "f" * 40) == {"commits": []}
+    p.repository_compare.assert_called_once_with("v0.1.0", "f" * 40)
+
+
+def test_project_sync_failure(tmp_path, upstream):
+    url, _path, _shas = upstream
+    mirror = Mirror(str(tmp_path / "cache"), url)
+    p = make_project()
+    assert mirror.project(p, "foo/missing") is p
+
+
+def test_prime(tmp_path, upstream):
+    url, _path, _shas = upstream
+    cache = tmp_path / "cache"
+    mirror = Mirror(str(cache), url)
+    mirror.prime()
+
+    # priming never evicts, even when over the size limit
+    clone = mirror.sync("foo/bar")
+    mirror = Mirror(str(cache), url, max_bytes=1)
+    with patch("shutil.rmtree") as rmtree:
+        mirror.prime()
+    rmtree.assert_not_called()
+    assert os.path.isdir(clone)
+
+    # failures are reported
+    mirror.set_deadline(0)
+    with pytest.raises(GitError, match="Failed to prime 1 of 1 clones"):
+        mirror.prime()
+
+
+def test_deadline(tmp_path, upstream):
+    url, _path, _shas = upstream
+    mirror = Mirror(str(tmp_path / "cache"), url)
+    p = make_project()
+
+    # no time left for git, so everything comes from the API
+    mirror.set_deadline(5)
+    assert mirror.project(p, "foo/bar") is p
+    assert not os.path.exists(tmp_path / "cache" / "foo%2Fbar.git")
+
+    mirror.set_deadline(60)
+    assert mirror.project(p, "foo/bar") is not p
+    mirror.set_deadline(None)
+    assert mirror.project(p, "foo/bar") is not p
+
+
+def test_evict(tmp_path, upstream):
+    url, path, _shas = upstream
+    other = str(tmp_path / "remote" / "foo" / "baz.git")
+    git(str(tmp_path), "clone", path, other)
+
+    cache = tmp_path / "cache"
+    mirror = Mirror(str(cache), url)
+    bar = mirror.sync("foo/bar")
+    os.utime(bar, (0, 0))
+
+    # the least recently used clone is evicted, never the one just synced
+    mirror = Mirror(str(cache), url, max_bytes=1)
+    baz = mirror.sync("foo/baz")
+    assert not os.path.exists(bar)
+    assert os.path.isdir(baz)
+
+
+def test_evict_sizes(tmp_path, upstream):
+    url, path, _shas = upstream
+    other = str(tmp_path / "remote" / "foo" / "baz.git")
+    git(str(tmp_path), "clone", path, other)
+    cache = tmp_path / "cache"
+    mirror = Mirror(str(cache), url)
+
+    # only the clone that was just synced is measured, the others come from the index
+    with patch("tagbotgitlab.mirror._du", wraps=_du) as du:
+        bar = mirror.sync("foo/bar")
+        baz = mirror.sync("foo/baz")
+        mirror.sync("foo/bar")
+    assert [c.args[0] for c in du.call_args_list] == [bar, baz, bar]
+    with open(cache / "sizes.json") as f:
+        assert json.load(f) == {"foo%2Fbar.git": _du(bar), "foo%2Fbaz.git": _du(baz)}
+
+    # clones missing from the index are measured once
+    os.remove(cache / "sizes.json")
+    with patch("tagbotgitlab.mirror._du", wraps=_du) as du:
+        mirror.evict()
+        mirror.evict()
+    assert sorted(c.args[0] for c in du.call_args_list) == [bar, baz]
+
+    # clones being synced or used are never evicted
+    mirror = Mirror(str(cache), url, max_bytes=1)
+    with mirror._repo_lock(baz), mirror.use(make_project(), "foo/bar"):
+        # the sync in `use` evicts neither
+        mirror.evict()
+        assert os.path.isdir(bar)
+        assert os.path.isdir(baz)
+    assert mirror._in_use == {}
+    with mirror._repo_lock(baz):
+        mirror.evict()
+    assert os.path.isdir(baz)
+    assert not os.path.exists(bar)
+    with open(cache / "sizes.json") as f:
+        assert json.load(f).keys() == {"foo%2Fbaz.git"}
@@ -1,7 +1,14 @@
+import json
+import os
+import subprocess
+import time
 from os import environ as env
 from unittest.mock import ANY, Mock, call, patch
 
 import gitlab
+import pytest
+
+from tagbotgitlab.mirror import GitError, Mirror
 
 
 # Set some environment variables required for import.
@@ -27,6 +34,19 @@ good_body_with_html = (
     "• Triggered by: @john.doe<br>"
 )
 
+# MRs registering several packages contain one block per package
+multi_body_with_html = (
+    "• Registering package: Example<br>"
+    "• Repository: gitlab.foo.com/foo/bar<br>"
+    "• Version: v0.1.2<br>"
+    "• Commit: abcdef<br>"
+    "• Registering package: Other<br>"
+    "• Repository: https://gitlab.foo.com/foo/baz<br>"
+    "• Version: v1.0.0<br>"
+    "• Commit: 123456<br>"
+    "• Triggered by: @john.doe<br>"
+)
+
 
 def test_parse_body():
     repo, version, commit, err = tagbot.parse_body(good_body)
@@ -76,6 +96,48 @@ def test_parse_body():
     assert repo == "p1/p2/p3/goodRepo"
 
 
+def test_parse_registrations():
+    assert list(tagbot.parse_registrations(good_body)) == [
+        ("foo/bar", "v0.1.2", "abcdef")
+    ]
+    assert list(tagbot.parse_registrations(good_body_with_html)) == [
+        ("foo/bar", "v0.1.2", "abcdef")
+    ]
+    assert list(tagbot.parse_registrations(multi_body_with_html)) == [
+        ("foo/bar", "v0.1.2", "abcdef"),
+        ("foo/baz", "v1.0.0", "123456"),
+    ]
+    assert list(tagbot.parse_registrations("")) == []
+    assert list(tagbot.parse_registrations("Repository: gitlab.foo.com/foo/bar")) == []
+
+    # incomplete blocks are skipped
+    body = (
+        "Repository: gitlab.foo.com/foo/bar\nCommit: abcdef\n"
+        "Repository: gitlab.foo.com/foo/baz\nVersion: v1.0.0\nCommit: 123456"
+    )
+    assert list(tagbot.parse_registrations(body)) == [("foo/baz", "v1.0.0", "123456")]
+
+    # version and commit in any order after the repository
+    body = "Repository: gitlab.foo.com/foo/bar\nCommit: abcdef\nVersion: v0.1.2"
+    assert list(tagbot.parse_registrations(body)) == [("foo/bar", "v0.1.2", "abcdef")]
+
+    # blocks not starting with the repository are dropped
+    body = "Commit: abcdef\nVersion: v0.1.2\nRepository: gitlab.foo.com/foo/bar"
+    assert list(tagbot.parse_registrations(body)) == []
+
+    # fields of different blocks are never joined
+    body = (
+        "Repository: gitlab.foo.com/g/a\nVersion: v1.0.0\n\n"
+        "Commit: bbb\nRepository: gitlab.foo.com/g/b\nVersion: v2.0.0"
+    )
+    assert list(tagbot.parse_registrations(body)) == []
+    body = (
+        "Repository: gitlab.foo.com/g/a\nVersion: v1.0.0\nVersion: v2.0.0\n"
+        "Commit: bbb"
+    )
+    assert list(tagbot.parse_registrations(body)) == []
+
+
 def test_get_in():
     d = {"a": {"b": {"c": "d"}}}
     assert tagbot.get_in(d, "a", "b", "c") == "d"
@@ -97,6 +159,66 @@ def test_handler(handle_event):
     handle_event.side_effect = RuntimeError()
     assert tagbot.handler(d, None) == {"statusCode": 500, "body": "Runtime error"}
 
+    # git commands are bounded by the time left in the invocation
+    ctx = Mock(get_remaining_time_in_millis=Mock(return_value=29000))
+    with patch.object(tagbot, "mirror") as mirror:
+        tagbot.handler(d, ctx)
+    mirror.set_deadline.assert_called_once_with(29.0)
+
+
+@patch.object(tagbot.client, "auth")
+@patch("tagbotgitlab.tagbot.handle_event")
+def test_handler_warmup(handle_event, auth):
+    evt = {"source": "aws.events", "detail-type": "Scheduled Event"}
+
+    with patch.object(tagbot, "mirror") as mirror:
+        resp = tagbot.handler(evt, None)
+    assert resp["statusCode"] == 200
+    steps = json.loads(resp["body"])["warmup"]
+    assert steps.keys() == {"changelog", "api", "mirror"}
+    assert all(step["ok"] and step["ms"] >= 0 for step in steps.values())
+    auth.assert_called_once_with()
+    mirror.prime.assert_called_once_with()
+    mirror.evict.assert_not_called()
+    handle_event.assert_not_called()
+
+    # a failing step is reported, the others still run
+    auth.side_effect = gitlab.GitlabAuthenticationError()
+    resp = tagbot.handler(evt, None)
+    assert resp["statusCode"] == 500
+    steps = json.loads(resp["body"])["warmup"]
+    assert steps.keys() == {"changelog", "api"}
+    assert steps["changelog"]["ok"]
+    assert not steps["api"]["ok"]
+
+    # other scheduled events still need the token
+    evt = {"source": "aws.events", "detail-type": "Other"}
+    assert tagbot.handler(evt, None) == {"statusCode": 403, "body": "Invalid token"}
+
+
+@patch("tagbotgitlab.tagbot.handle_event")
+def test_handler_warmup_after_webhook(handle_event, tmp_path):
+    cache = tmp_path / "cache"
+    os.makedirs(cache)
+    subprocess.run(["git", "init", "-q", "--bare", str(cache / "foo.git")], check=True)
+    mirror = Mirror(str(cache), "file:///nowhere")
+    evt = {"source": "aws.events", "detail-type": "Scheduled Event"}
+    d = {"headers": {"X-Gitlab-Token": "abc"}}
+
+    with patch.object(tagbot.client, "auth"), patch.object(tagbot, "mirror", mirror):
+        # a webhook whose deadline for git has passed by the time of the warm-up
+        ctx = Mock(get_remaining_time_in_millis=Mock(return_value=10100))
+        tagbot.handler(d, ctx)
+        time.sleep(0.2)
+        with pytest.raises(GitError):
+            mirror.prime()
+
+        ctx = Mock(get_remaining_time_in_millis=Mock(return_value=29000))
+        with patch("subprocess.run", wraps=subprocess.run) as run:
+            resp = tagbot.handler(evt, ctx)
+    assert json.loads(resp["body"])["warmup"]["mirror"]["ok"]
+    assert run.call_args.args[0][-2] == "for-each-ref"
+
 
 @patch("tagbotgitlab.tagbot.handle_merge")
 @patch("tagbotgitlab.tagbot.handle_open")
@@ -258,6 +380,18 @@ def test_handle_merge():
         parse_fail = True
     assert parse_fail
 
+    # fields that parse_body accepts, but that don't form a registration block
+    payload["object_attributes"]["description"] = (
+        "Version: v0.1.2\nRepository: gitlab.foo.com/foo/baz\n"
+        "Repository: gitlab.foo.com/foo/bar\nCommit: abcdef"
+    )
+    try:
+        parse_fail = None
+        tagbot.handle_merge(payload)
+    except Exception as e:
+        parse_fail = str(e)
+    assert parse_fail == "Parsing MR description failed. Fields out of order"
+
     # all valid
     payload = {
         "object_attributes": {
@@ -277,6 +411,57 @@ def test_handle_merge():
         {"tag_name": "v0.1.2", "ref": "abcdef", "description": ANY, "name": "v0.1.2"}
     )
 
+    # with a mirror, the changelog is generated while its clone is in use
+    with patch.object(tagbot, "mirror") as mirror:
+        mirror.use.return_value.__enter__.return_value = p
+        tagbot.handle_merge(payload)
+    mirror.use.assert_called_once_with(p, "foo/bar")
+    mirror.use.return_value.__exit__.assert_called_once()
+
+    # multiple packages registered in one MR
+    tagbot.client.projects.get.reset_mock()
+    p.releases.create.reset_mock()
+    payload["object_attributes"]["description"] = multi_body_with_html
+    result = tagbot.handle_merge(payload)
+    assert result.splitlines() == [
+        "Created release and tag v0.1.2 for foo/bar at abcdef",
+        "Created release and tag v1.0.0 for foo/baz at 123456",
+    ]
+    tagbot.client.projects.get.assert_has_calls(
+        [call("foo/bar", lazy=True), call("foo/baz", lazy=True)], any_order=True
+    )
+    p.releases.create.assert_has_calls(
+        [
+            call({"tag_name": v, "ref": c, "description": ANY, "name": v})
+            for v, c in [("v0.1.2", "abcdef"), ("v1.0.0", "123456")]
+        ],
+        any_order=True,
+    )
+
+    # repeated registrations are only released once
+    tagbot.client.projects.get.reset_mock()
+    p.releases.create.reset_mock()
+    payload["object_attributes"]["description"] = good_body + good_body_with_html
+    assert (
+        tagbot.handle_merge(payload)
+        == "Created release and tag v0.1.2 for foo/bar at abcdef"
+    )
+    p.releases.create.assert_called_once()
+    payload["object_attributes"]["description"] = multi_body_with_html
+
+    # a failure for one package is reported, the others are still released
+    p.releases.create.reset_mock()
+    p.releases.create.side_effect = [None, gitlab.GitlabCreateError()]
+    try:
+        tagbot.handle_merge(payload)
+        release_fail = None
+    except Exception as e:
+        release_fail = str(e)
+    assert release_fail is not None
+    assert "Failed to create release and tag" in release_fail
+    assert "Created release and tag" in release_fail
+    assert p.releases.create.call_count == 2
+
 
 @patch("time.sleep", return_value=None)
 def test_handle_open(patched_time_sleep):